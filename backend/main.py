@@ -1,18 +1,23 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, Request
+from fastapi.responses import HTMLResponse, FileResponse, RedirectResponse, Response, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 import google.genai as genai
 from google.genai import types
+from google.genai import errors as genai_errors
 import httpx
+import asyncio
 import os
 import base64
-import io
+import hashlib
 import json
 import math
-import requests
+import re
+import secrets
+import time
 import jwt
+from collections import OrderedDict, defaultdict, deque
 from datetime import datetime, timedelta, timezone
 from typing import List, Optional
 
@@ -38,6 +43,14 @@ GEMINI_MODELS = {
 
 GEMINI_MODEL = os.environ.get("GEMINI_MODEL", GEMINI_MODELS["nano_banana_2"])
 
+# Optional comma-separated fallbacks (GEMINI_MODELS keys or raw model ids),
+# tried in order when the primary model fails or its circuit is open
+GEMINI_FALLBACK_MODELS = [
+    GEMINI_MODELS.get(name.strip(), name.strip())
+    for name in os.environ.get("GEMINI_FALLBACK_MODELS", "").split(",")
+    if name.strip() and GEMINI_MODELS.get(name.strip(), name.strip()) != GEMINI_MODEL
+]
+
 client = genai.Client(
     api_key=api_key,
     http_options=types.HttpOptions(
@@ -54,17 +67,66 @@ JWT_EXPIRE_HOURS = 24
 security = HTTPBearer()
 
 
-class LoginRequest(BaseModel):
-    password: str
+# Interactive callers (the web UI) are served ahead of bulk/batch callers
+PRIORITY_CLASSES = ("interactive", "bulk")
+TOKEN_CACHE_SIZE = 1024
+SCHEDULER_IDLE_SECONDS = 600
 
+# Optional fair-share weights per caller id, e.g. "alice=2,nightly-batch=0.5"
+CALLER_WEIGHTS = {
+    name.strip(): float(weight)
+    for name, _, weight in (
+        entry.partition("=") for entry in os.environ.get("CALLER_WEIGHTS", "").split(",") if "=" in entry
+    )
+}
 
-def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> None:
-    try:
-        jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[JWT_ALGORITHM])
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Token expired")
-    except jwt.InvalidTokenError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+
+class LoginRequest(BaseModel):
+    password: str
+    caller: Optional[str] = None      # stable name for scripts; the UI gets a fresh id per login
+    priority: str = "bulk"            # the web UI asks for "interactive" explicitly
+
+
+class Caller:
+    """Identity and priority class carried in a verified token."""
+
+    def __init__(self, caller_id: str, priority: str, expires_at: float):
+        self.caller_id = caller_id
+        self.priority = priority if priority in PRIORITY_CLASSES else "interactive"
+        self.weight = max(CALLER_WEIGHTS.get(caller_id, 1.0), 0.01)
+        self.expires_at = expires_at
+
+
+# Decoded tokens, so frequent calls such as /fal/poll skip the signature check
+_token_cache: OrderedDict = OrderedDict()
+
+
+async def verify_token(
+    request: Request,
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+) -> Caller:
+    token = credentials.credentials
+    caller = _token_cache.get(token)
+    if caller is not None:
+        if caller.expires_at <= time.time():
+            _token_cache.pop(token, None)
+            raise HTTPException(status_code=401, detail="Token expired")
+        _token_cache.move_to_end(token)
+    if caller is None:
+        try:
+            claims = jwt.decode(token, SECRET_KEY, algorithms=[JWT_ALGORITHM])
+        except jwt.ExpiredSignatureError:
+            raise HTTPException(status_code=401, detail="Token expired")
+        except jwt.InvalidTokenError:
+            raise HTTPException(status_code=401, detail="Invalid token")
+        # Tokens issued before caller identities existed carry sub "user" and no priority
+        caller = Caller(claims.get("sub", "user"), claims.get("prio", "interactive"), claims["exp"])
+        _token_cache[token] = caller
+        if len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+    # run_upstream reads the caller from here to schedule provider calls
+    request.state.caller = caller
+    return caller
 
 
 @api.post("/auth/login")
@@ -73,9 +135,15 @@ async def login(request: LoginRequest):
         raise HTTPException(status_code=500, detail="APP_PASSWORD not configured on server")
     if request.password != APP_PASSWORD:
         raise HTTPException(status_code=401, detail="Invalid password")
+    if request.priority not in PRIORITY_CLASSES:
+        raise HTTPException(status_code=400, detail=f"priority must be one of {', '.join(PRIORITY_CLASSES)}")
+    caller_id = (request.caller or "").strip() or f"user-{secrets.token_hex(4)}"
     expire = datetime.now(timezone.utc) + timedelta(hours=JWT_EXPIRE_HOURS)
-    token = jwt.encode({"sub": "user", "exp": expire}, SECRET_KEY, algorithm=JWT_ALGORITHM)
-    return {"access_token": token, "token_type": "bearer"}
+    token = jwt.encode(
+        {"sub": caller_id, "prio": request.priority, "exp": expire},
+        SECRET_KEY, algorithm=JWT_ALGORITHM,
+    )
+    return {"access_token": token, "token_type": "bearer", "caller": caller_id, "priority": request.priority}
 
 
 # ── Fal.AI configuration ─────────────────────────────────────────────────────
@@ -156,12 +224,794 @@ async def upload_to_fal_storage(image_bytes: bytes, content_type: str = "image/p
     return await fal_client.upload_async(image_bytes, content_type)
 
 
+# ── Request deadlines & cancellation ──────────────────────────────────────────
+# Every API request gets an end-to-end time budget. Callers may ask for a
+# shorter or longer one via `deadline_seconds`, capped at the server maximum.
+REQUEST_DEADLINE_SECONDS = float(os.environ.get("REQUEST_DEADLINE_SECONDS", "120"))
+MAX_REQUEST_DEADLINE_SECONDS = float(os.environ.get("MAX_REQUEST_DEADLINE_SECONDS", "300"))
+DISCONNECT_POLL_SECONDS = 0.5
+
+# Per-endpoint counters, exposed via GET /metrics
+request_metrics = {
+    "cancelled": defaultdict(int),
+    "deadline_exceeded": defaultdict(int),
+}
+
+
+class DeadlineExceeded(Exception):
+    """The request ran out of its time budget before upstream work finished."""
+
+
+class ClientDisconnected(Exception):
+    """The caller went away before upstream work finished."""
+
+
+class Deadline:
+    """Absolute time budget for one API request, shared by all its upstream calls."""
+
+    def __init__(self, seconds: Optional[float] = None):
+        if not seconds or seconds <= 0:
+            seconds = REQUEST_DEADLINE_SECONDS
+        self.seconds = min(seconds, MAX_REQUEST_DEADLINE_SECONDS)
+        self.expires_at = time.monotonic() + self.seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def http_timeout(self, read: float = 30.0, connect: float = 10.0) -> httpx.Timeout:
+        """httpx timeout for a single upstream call, never exceeding the remaining budget."""
+        remaining = self.remaining()
+        return httpx.Timeout(min(read, remaining), connect=min(connect, remaining))
+
+    def gemini_http_options(self) -> types.HttpOptions:
+        """Per-call Gemini HTTP options; the SDK expects the timeout in milliseconds."""
+        return types.HttpOptions(timeout=max(1, int(self.remaining() * 1000)))
+
+
+# ── Circuit breakers ──────────────────────────────────────────────────────────
+# One breaker per provider/model (e.g. "gemini:gemini-3.1-flash-image",
+# "fal:openai/gpt-image-2/edit", "fal:storage"). A breaker opens when the
+# rolling error rate or slow-call rate crosses its threshold, fails fast while
+# open, then lets a limited number of half-open trial calls probe recovery.
+BREAKER_WINDOW_SECONDS = float(os.environ.get("BREAKER_WINDOW_SECONDS", "60"))
+BREAKER_MIN_CALLS = int(os.environ.get("BREAKER_MIN_CALLS", "5"))
+BREAKER_ERROR_RATE = float(os.environ.get("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_CALL_SECONDS = float(os.environ.get("BREAKER_SLOW_CALL_SECONDS", "90"))
+BREAKER_SLOW_CALL_RATE = float(os.environ.get("BREAKER_SLOW_CALL_RATE", "0.8"))
+BREAKER_OPEN_SECONDS = float(os.environ.get("BREAKER_OPEN_SECONDS", "30"))
+BREAKER_HALF_OPEN_TRIALS = int(os.environ.get("BREAKER_HALF_OPEN_TRIALS", "1"))
+
+
+class CircuitOpen(Exception):
+    """The provider's breaker is open; the call was rejected without trying it."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} is temporarily unavailable; retry in {math.ceil(retry_after)}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Rolling-window breaker for one provider/model: closed → open → half_open → closed."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.trials_in_flight = 0
+        self.calls = deque()  # (finished_at, ok, duration)
+
+    def _prune(self, now: float) -> None:
+        while self.calls and self.calls[0][0] < now - BREAKER_WINDOW_SECONDS:
+            self.calls.popleft()
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + BREAKER_OPEN_SECONDS - time.monotonic())
+
+    def acquire(self) -> None:
+        """Admit a call or raise CircuitOpen."""
+        if self.state == "open":
+            if self.retry_after() > 0:
+                raise CircuitOpen(self.name, self.retry_after())
+            self.state = "half_open"
+            self.trials_in_flight = 0
+        if self.state == "half_open":
+            if self.trials_in_flight >= BREAKER_HALF_OPEN_TRIALS:
+                raise CircuitOpen(self.name, BREAKER_OPEN_SECONDS)
+            self.trials_in_flight += 1
+
+    def release(self) -> None:
+        """Give back an admission without judging the provider (e.g. the client left)."""
+        if self.state == "half_open":
+            self.trials_in_flight = max(0, self.trials_in_flight - 1)
+
+    def record(self, ok: bool, duration: float) -> None:
+        now = time.monotonic()
+        if self.state == "half_open":
+            self.trials_in_flight = max(0, self.trials_in_flight - 1)
+            if ok and duration < BREAKER_SLOW_CALL_SECONDS:
+                self.state = "closed"
+                self.calls.clear()
+            else:
+                self._trip(now)
+            return
+        self.calls.append((now, ok, duration))
+        self._prune(now)
+        if self.state == "closed" and len(self.calls) >= BREAKER_MIN_CALLS:
+            errors = sum(1 for _, call_ok, _ in self.calls if not call_ok)
+            slow = sum(1 for _, _, d in self.calls if d >= BREAKER_SLOW_CALL_SECONDS)
+            if errors / len(self.calls) >= BREAKER_ERROR_RATE or slow / len(self.calls) >= BREAKER_SLOW_CALL_RATE:
+                self._trip(now)
+
+    def _trip(self, now: float) -> None:
+        print(f"[breaker] {self.name} opened")
+        self.state = "open"
+        self.opened_at = now
+        self.calls.clear()
+
+    def snapshot(self) -> dict:
+        self._prune(time.monotonic())
+        calls = len(self.calls)
+        return {
+            "state": self.state,
+            "calls": calls,
+            "error_rate": round(sum(1 for _, ok, _ in self.calls if not ok) / calls, 3) if calls else 0.0,
+            "retry_after": round(self.retry_after(), 1) if self.state == "open" else 0.0,
+        }
+
+
+breakers: dict = {}
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    if name not in breakers:
+        breakers[name] = CircuitBreaker(name)
+    return breakers[name]
+
+
+def is_provider_fault(exc: Exception) -> bool:
+    """
+    Whether a failure says something about provider health (vs. a bad request).
+
+    Only transport failures and 5xx/429 API responses count; validation errors,
+    ValueError and the like are our (or the caller's) problem, not the provider's.
+    """
+    if isinstance(exc, (httpx.TransportError, TimeoutError)):
+        return True
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+    elif isinstance(exc, genai_errors.APIError):
+        status = exc.code
+    elif isinstance(getattr(exc, "status_code", None), int):
+        # fal_client.client.FalClientHTTPError (fal_client is imported lazily)
+        status = exc.status_code
+    else:
+        return False
+    return status >= 500 or status == 429
+
+
+def circuit_open_response(e: CircuitOpen) -> JSONResponse:
+    return JSONResponse(
+        status_code=503,
+        content={"error": str(e), "error_type": "CircuitOpen", "retry_after": math.ceil(e.retry_after)},
+        headers={"Retry-After": str(math.ceil(e.retry_after))},
+    )
+
+
+# ── Upstream scheduler ────────────────────────────────────────────────────────
+# Provider calls (those guarded by a breaker) need one of UPSTREAM_CONCURRENCY
+# slots for their provider; Gemini and Fal.AI have separate pools, so quick
+# Fal.AI uploads never wait behind long Gemini generations. When slots are scarce, queued interactive calls go before bulk ones,
+# and within a lane callers get slots in proportion to their weight (stride
+# scheduling over per-caller virtual time), FIFO per caller.
+UPSTREAM_CONCURRENCY = int(os.environ.get("UPSTREAM_CONCURRENCY", "8"))
+
+# Fal.AI jobs keep running in Fal's queue (under the shared FAL_KEY) long after
+# the submit POST returns, so each job also holds one of FAL_CONCURRENT_JOBS
+# slots until /fal/poll sees it finish, or FAL_JOB_PENDING_SECONDS pass
+# without that happening.
+FAL_CONCURRENT_JOBS = int(os.environ.get("FAL_CONCURRENT_JOBS", "8"))
+FAL_JOB_PENDING_SECONDS = float(os.environ.get("FAL_JOB_PENDING_SECONDS", "300"))
+
+
+class _Ticket:
+    def __init__(self, caller: Caller):
+        self.caller = caller
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+
+
+class FairScheduler:
+    """Weighted fair-share admission for upstream provider calls with priority lanes."""
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.in_flight = 0
+        self.lanes = {priority: {} for priority in PRIORITY_CLASSES}  # caller_id -> deque of tickets
+        self.pass_values = {}    # caller_id -> virtual time of that caller's next grant
+        self.virtual_time = 0.0
+        self.stats = {}          # caller_id -> per-caller counters
+
+    def _caller_stats(self, caller: Caller) -> dict:
+        if caller.caller_id not in self.stats:
+            self.stats[caller.caller_id] = {
+                "priority": caller.priority, "weight": caller.weight,
+                "in_flight": 0, "served": 0, "wait_total": 0.0, "wait_max": 0.0,
+            }
+        stats = self.stats[caller.caller_id]
+        stats["last_active"] = time.monotonic()
+        return stats
+
+    def _queued(self, caller_id: str) -> int:
+        # The same caller id may log in again with another priority
+        return sum(len(lane.get(caller_id, ())) for lane in self.lanes.values())
+
+    def _prune_idle(self) -> None:
+        """Forget callers with nothing queued or in flight for SCHEDULER_IDLE_SECONDS."""
+        cutoff = time.monotonic() - SCHEDULER_IDLE_SECONDS
+        idle = [
+            caller_id for caller_id, stats in self.stats.items()
+            if stats["last_active"] < cutoff and not stats["in_flight"] and not self._queued(caller_id)
+        ]
+        for caller_id in idle:
+            del self.stats[caller_id]
+            # A returning caller restarts at the current virtual time, as any idle caller would
+            self.pass_values.pop(caller_id, None)
+
+    def _grant(self, ticket: _Ticket) -> None:
+        caller = ticket.caller
+        start = max(self.pass_values.get(caller.caller_id, 0.0), self.virtual_time)
+        self.virtual_time = start
+        self.pass_values[caller.caller_id] = start + 1.0 / caller.weight
+        self.in_flight += 1
+        waited = time.monotonic() - ticket.enqueued_at
+        stats = self._caller_stats(caller)
+        stats["in_flight"] += 1
+        stats["served"] += 1
+        stats["wait_total"] += waited
+        stats["wait_max"] = max(stats["wait_max"], waited)
+        ticket.granted = True
+        if not ticket.future.done():
+            ticket.future.set_result(None)
+
+    def _dispatch(self) -> None:
+        while self.in_flight < self.slots:
+            lane = next((self.lanes[p] for p in PRIORITY_CLASSES if self.lanes[p]), None)
+            if lane is None:
+                return
+            caller_id = min(lane, key=lambda c: max(self.pass_values.get(c, 0.0), self.virtual_time))
+            queue = lane[caller_id]
+            ticket = queue.popleft()
+            if not queue:
+                del lane[caller_id]
+            self._grant(ticket)
+
+    def enqueue(self, caller: Caller) -> _Ticket:
+        ticket = _Ticket(caller)
+        self._prune_idle()
+        stats = self._caller_stats(caller)
+        stats["priority"], stats["weight"] = caller.priority, caller.weight
+        self.lanes[caller.priority].setdefault(caller.caller_id, deque()).append(ticket)
+        self._dispatch()
+        return ticket
+
+    async def wait(self, ticket: _Ticket) -> None:
+        await ticket.future
+
+    def release(self, ticket: _Ticket) -> None:
+        """Return a granted slot, or drop the ticket from its queue if it was never granted."""
+        if ticket.granted:
+            ticket.granted = False
+            self.in_flight -= 1
+            self._caller_stats(ticket.caller)["in_flight"] -= 1
+        else:
+            lane = self.lanes[ticket.caller.priority]
+            queue = lane.get(ticket.caller.caller_id)
+            if queue and ticket in queue:
+                queue.remove(ticket)
+                if not queue:
+                    del lane[ticket.caller.caller_id]
+        self._dispatch()
+
+    def snapshot(self) -> dict:
+        self._prune_idle()
+        callers = {}
+        for caller_id, stats in self.stats.items():
+            callers[caller_id] = {
+                "priority": stats["priority"],
+                "weight": stats["weight"],
+                "queued": self._queued(caller_id),
+                "in_flight": stats["in_flight"],
+                "served": stats["served"],
+                "avg_wait_ms": round(stats["wait_total"] / stats["served"] * 1000, 1) if stats["served"] else 0.0,
+                "max_wait_ms": round(stats["wait_max"] * 1000, 1),
+            }
+        return {"slots": self.slots, "in_flight": self.in_flight, "callers": callers}
+
+
+# Keyed by the provider prefix of breaker names ("gemini:<model>", "fal:<path>")
+schedulers = {provider: FairScheduler(UPSTREAM_CONCURRENCY) for provider in ("gemini", "fal")}
+
+
+class FalJobSlots:
+    """Fair-share slots held by outstanding Fal.AI jobs, from submit until the job finishes."""
+
+    def __init__(self, slots: int):
+        self.scheduler = FairScheduler(slots)
+        self._by_response_url = {}   # response_url -> (ticket, expiry timer)
+
+    async def acquire(self, http_request: Optional[Request], deadline: Deadline, endpoint: str) -> Optional[_Ticket]:
+        """Wait for a job slot on behalf of the request's caller (None if it has no caller)."""
+        caller = getattr(http_request.state, "caller", None) if http_request is not None else None
+        if caller is None:
+            return None
+        ticket = self.scheduler.enqueue(caller)
+        try:
+            await _await_upstream(self.scheduler.wait(ticket), deadline, http_request, endpoint)
+        except BaseException:
+            self.scheduler.release(ticket)
+            raise
+        return ticket
+
+    def release(self, ticket: Optional[_Ticket]) -> None:
+        """Give back a slot whose submit failed."""
+        if ticket is not None:
+            self.scheduler.release(ticket)
+
+    def watch(self, ticket: Optional[_Ticket], response_url: str) -> None:
+        """Keep the slot until finish() is called for response_url, or the job is abandoned."""
+        if ticket is None:
+            return
+        # Nobody polling the job to completion must not hold its slot forever
+        timer = asyncio.get_running_loop().call_later(FAL_JOB_PENDING_SECONDS, self.finish, response_url)
+        self._by_response_url[response_url] = (ticket, timer)
+
+    def finish(self, response_url: str) -> None:
+        entry = self._by_response_url.pop(response_url, None)
+        if entry is not None:
+            ticket, timer = entry
+            timer.cancel()
+            self.scheduler.release(ticket)
+
+
+fal_jobs = FalJobSlots(FAL_CONCURRENT_JOBS)
+
+
+async def run_upstream(
+    coro,
+    deadline: Deadline,
+    http_request: Optional[Request],
+    endpoint: str,
+    breaker: Optional[str] = None,
+):
+    """
+    Await an upstream coroutine under the request deadline.
+
+    The coroutine runs as a task while we watch the clock and the client
+    connection. If the budget runs out or the browser disconnects, the task
+    is cancelled immediately instead of waiting out the HTTP timeout.
+
+    With `breaker` set, the call is a provider call: it is admitted by (and
+    its outcome recorded on) that provider's circuit breaker, then waits for
+    a scheduler slot on behalf of the caller that verify_token identified.
+    """
+    circuit = get_breaker(breaker) if breaker else None
+    if circuit is not None:
+        try:
+            circuit.acquire()
+        except CircuitOpen:
+            coro.close()
+            raise
+    caller = getattr(http_request.state, "caller", None) if circuit is not None and http_request is not None else None
+    scheduler = schedulers[breaker.split(":", 1)[0]] if caller is not None else None
+    ticket = None
+    try:
+        if caller is not None:
+            # Queue time counts against the deadline, and a disconnect drops the ticket
+            ticket = scheduler.enqueue(caller)
+            try:
+                await _await_upstream(scheduler.wait(ticket), deadline, http_request, endpoint)
+            except BaseException:
+                # Never started: don't leak the coroutine or a half-open breaker trial
+                circuit.release()
+                coro.close()
+                raise
+        started = time.monotonic()
+        try:
+            result = await _await_upstream(coro, deadline, http_request, endpoint)
+        except ClientDisconnected:
+            if circuit is not None:
+                circuit.release()
+            raise
+        except DeadlineExceeded:
+            # The budget is caller-chosen, so running out of it only counts as a slow call
+            if circuit is not None:
+                duration = time.monotonic() - started
+                if duration >= BREAKER_SLOW_CALL_SECONDS:
+                    circuit.record(True, duration)
+                else:
+                    circuit.release()
+            raise
+        except Exception as e:
+            if circuit is not None:
+                if is_provider_fault(e):
+                    circuit.record(False, time.monotonic() - started)
+                else:
+                    circuit.release()
+            raise
+        if circuit is not None:
+            circuit.record(True, time.monotonic() - started)
+        return result
+    finally:
+        if ticket is not None:
+            scheduler.release(ticket)
+
+
+async def _await_upstream(coro, deadline: Deadline, http_request: Optional[Request], endpoint: str):
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            remaining = deadline.remaining()
+            if remaining <= 0:
+                request_metrics["deadline_exceeded"][endpoint] += 1
+                raise DeadlineExceeded(f"Request deadline of {deadline.seconds:g}s exceeded")
+            done, _ = await asyncio.wait({task}, timeout=min(DISCONNECT_POLL_SECONDS, remaining))
+            if done:
+                try:
+                    return task.result()
+                except httpx.TimeoutException:
+                    # The per-call timeout was derived from the deadline; report it as such
+                    if deadline.remaining() > DISCONNECT_POLL_SECONDS:
+                        raise
+                    request_metrics["deadline_exceeded"][endpoint] += 1
+                    raise DeadlineExceeded(f"Request deadline of {deadline.seconds:g}s exceeded")
+            if http_request is not None and await http_request.is_disconnected():
+                request_metrics["cancelled"][endpoint] += 1
+                raise ClientDisconnected("Client disconnected; upstream request cancelled")
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+# ── Local image store ─────────────────────────────────────────────────────────
+# Completed Fal.AI results are mirrored here in the background so the browser
+# can load them from our origin instead of the Fal CDN, which expires media.
+# Image ids are the SHA-256 of the source URL, so they are as unguessable as
+# the CDN URL they replace.
+IMAGE_STORE_DIR = os.environ.get("IMAGE_STORE_DIR", "data/images")
+IMAGE_STORE_RETENTION_DAYS = float(os.environ.get("IMAGE_STORE_RETENTION_DAYS", "7"))
+IMAGE_MIRROR_MAX_BYTES = int(os.environ.get("IMAGE_MIRROR_MAX_MB", "50")) * 1024 * 1024
+IMAGE_STORE_PRUNE_INTERVAL_SECONDS = 3600
+FAL_CDN_RETENTION_HOURS = float(os.environ.get("FAL_CDN_RETENTION_HOURS", "24"))
+IMAGE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+# Only results hosted on the Fal CDN are mirrored. response_url comes from the
+# browser, so anything else (e.g. internal addresses) must never be fetched.
+FAL_CDN_HOSTS = ("fal.media",)
+
+_IMAGE_ID_RE = re.compile(r"[0-9a-f]{64}")
+_LOCAL_IMAGE_URL_RE = re.compile(r"/api/images/([0-9a-f]{64})$")
+
+# In-flight mirror downloads, keyed by image id
+_mirror_tasks: dict = {}
+_last_prune = 0.0
+
+
+def _image_paths(image_id: str):
+    base = os.path.join(IMAGE_STORE_DIR, image_id)
+    return base, base + ".json"
+
+
+def read_image_meta(image_id: str) -> Optional[dict]:
+    _, meta_path = _image_paths(image_id)
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_image_meta(image_id: str, meta: dict) -> None:
+    _, meta_path = _image_paths(image_id)
+    os.makedirs(IMAGE_STORE_DIR, exist_ok=True)
+    tmp_path = meta_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+
+def is_fal_cdn_url(url: str) -> bool:
+    try:
+        parsed = httpx.URL(url)
+    except (httpx.InvalidURL, TypeError):
+        return False
+    host = parsed.host.lower()
+    return parsed.scheme == "https" and any(host == h or host.endswith("." + h) for h in FAL_CDN_HOSTS)
+
+
+def prune_image_store() -> None:
+    """Delete mirrored images (and leftover partial files) older than the retention period."""
+    cutoff = time.time() - IMAGE_STORE_RETENTION_DAYS * 86400
+    try:
+        names = os.listdir(IMAGE_STORE_DIR)
+    except OSError:
+        return
+    for name in names:
+        if name.split(".", 1)[0] in _mirror_tasks:
+            continue
+        path = os.path.join(IMAGE_STORE_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def parse_local_image_id(url: str) -> Optional[str]:
+    """Return the image id if `url` points at our own /api/images endpoint."""
+    match = _LOCAL_IMAGE_URL_RE.search(url.strip().split("?", 1)[0])
+    return match.group(1) if match else None
+
+
+async def mirror_remote_image(image_id: str, source_url: str) -> None:
+    """Stream a remote image into the local store, writing atomically and capping its size."""
+    data_path, _ = _image_paths(image_id)
+    tmp_path = data_path + ".part"
+    received = 0
+    try:
+        async with httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=10.0)) as http:
+            async with http.stream("GET", source_url) as resp:
+                resp.raise_for_status()
+                if int(resp.headers.get("content-length") or 0) > IMAGE_MIRROR_MAX_BYTES:
+                    raise ValueError("image exceeds IMAGE_MIRROR_MAX_MB")
+                content_type = resp.headers.get("content-type", "image/png").split(";")[0]
+                with open(tmp_path, "wb") as f:
+                    async for chunk in resp.aiter_bytes(64 * 1024):
+                        received += len(chunk)
+                        if received > IMAGE_MIRROR_MAX_BYTES:
+                            raise ValueError("image exceeds IMAGE_MIRROR_MAX_MB")
+                        await asyncio.to_thread(f.write, chunk)
+        os.replace(tmp_path, data_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    meta = read_image_meta(image_id) or {"source_url": source_url, "source_uploaded_at": time.time()}
+    meta["content_type"] = content_type
+    write_image_meta(image_id, meta)
+
+
+def schedule_image_mirror(source_url: str) -> Optional[str]:
+    """
+    Start mirroring `source_url` in the background (once) and return its local
+    image id, or None if the URL is not on the Fal CDN.
+    """
+    global _last_prune
+    if not is_fal_cdn_url(source_url):
+        return None
+    if time.monotonic() - _last_prune > IMAGE_STORE_PRUNE_INTERVAL_SECONDS:
+        _last_prune = time.monotonic()
+        asyncio.get_running_loop().run_in_executor(None, prune_image_store)
+
+    image_id = hashlib.sha256(source_url.encode()).hexdigest()
+    data_path, _ = _image_paths(image_id)
+    if image_id in _mirror_tasks or os.path.exists(data_path):
+        return image_id
+
+    # Record the source first so the image can still be served if mirroring fails
+    write_image_meta(image_id, {"source_url": source_url, "source_uploaded_at": time.time()})
+
+    async def _run():
+        try:
+            await mirror_remote_image(image_id, source_url)
+        except Exception as e:
+            print(f"[image store] mirror of {source_url} failed: {e}")
+        finally:
+            _mirror_tasks.pop(image_id, None)
+
+    _mirror_tasks[image_id] = asyncio.create_task(_run())
+    return image_id
+
+
+async def load_local_image(image_id: str, deadline: Deadline, http_request: Optional[Request], endpoint: str):
+    """Return (bytes, content_type) for a mirrored image, or None if we don't hold it."""
+    task = _mirror_tasks.get(image_id)
+    if task is not None:
+        # A slow mirror is waited on like any upstream call; shield keeps it running for others
+        await _await_upstream(asyncio.shield(task), deadline, http_request, endpoint)
+    data_path, _ = _image_paths(image_id)
+    meta = read_image_meta(image_id)
+    if meta is None or not os.path.exists(data_path):
+        return None
+    try:
+        image_bytes = await asyncio.to_thread(_read_file, data_path)
+    except OSError:
+        return None
+    return image_bytes, meta.get("content_type", "image/png")
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def resolve_fal_input_url(url: str, deadline: Deadline, http_request: Optional[Request], endpoint: str) -> str:
+    """
+    Turn an image reference from the browser into a URL Fal.AI can fetch.
+
+    Local store URLs map back to their Fal CDN source while it is still within
+    the retention window; otherwise the local copy is re-uploaded once and the
+    new CDN URL remembered.
+    """
+    image_id = parse_local_image_id(url)
+    if image_id is None:
+        return url.strip()
+    meta = read_image_meta(image_id)
+    if meta is None:
+        raise ValueError("Unknown image reference")
+    age_hours = (time.time() - meta.get("source_uploaded_at", 0)) / 3600
+    if meta.get("source_url") and age_hours < FAL_CDN_RETENTION_HOURS:
+        return meta["source_url"]
+    local = await load_local_image(image_id, deadline, http_request, endpoint)
+    if local is None:
+        return meta["source_url"]
+    image_bytes, content_type = local
+    meta["source_url"] = await run_upstream(
+        upload_to_fal_storage(image_bytes, content_type), deadline, http_request, endpoint, breaker="fal:storage",
+    )
+    meta["source_uploaded_at"] = time.time()
+    write_image_meta(image_id, meta)
+    return meta["source_url"]
+
+
+# ── Edit sessions ─────────────────────────────────────────────────────────────
+# Iterative edits keep the latest image server-side so follow-ups only send a
+# prompt. Gemini sessions keep the recent chat turns (including the model's
+# image output); Fal.AI sessions keep a reference to the latest result.
+EDIT_SESSION_IDLE_SECONDS = float(os.environ.get("EDIT_SESSION_IDLE_SECONDS", "1800"))
+EDIT_SESSION_MAX_SESSIONS = int(os.environ.get("EDIT_SESSION_MAX_SESSIONS", "200"))
+EDIT_SESSION_MAX_BYTES = int(os.environ.get("EDIT_SESSION_MAX_MB", "256")) * 1024 * 1024
+EDIT_SESSION_MAX_TURNS = int(os.environ.get("EDIT_SESSION_MAX_TURNS", "2"))
+EDIT_SESSION_PENDING_SECONDS = float(os.environ.get("EDIT_SESSION_PENDING_SECONDS", "600"))
+
+
+class EditSession:
+    def __init__(self, provider: str):
+        self.session_id = secrets.token_urlsafe(16)
+        self.provider = provider
+        self.history = []                 # Gemini: alternating user/model Content
+        self.image_url = None             # Fal.AI: URL of the latest image
+        self.pending_response_url = None  # Fal.AI: job whose result becomes the next image
+        self.pending_since = 0.0          # Fal.AI: when a follow-up claimed the session (0 = idle)
+        self.size = 0
+        self.last_used = time.monotonic()
+
+
+class EditSessionStore:
+    """In-memory LRU of edit sessions, bounded by count and bytes, with idle eviction."""
+
+    def __init__(self):
+        self._sessions = OrderedDict()
+        self._by_response_url = {}
+        self.total_bytes = 0
+
+    def _remove(self, session_id: str) -> None:
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self.total_bytes -= session.size
+            self._by_response_url.pop(session.pending_response_url, None)
+
+    def _evict(self) -> None:
+        cutoff = time.monotonic() - EDIT_SESSION_IDLE_SECONDS
+        # Least recently used first, so idle sessions sit at the front
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if (oldest.last_used < cutoff
+                    or len(self._sessions) > EDIT_SESSION_MAX_SESSIONS
+                    or self.total_bytes > EDIT_SESSION_MAX_BYTES):
+                self._remove(oldest.session_id)
+            else:
+                break
+
+    def _touch(self, session: EditSession) -> None:
+        """Mark the session used, re-inserting it if it was evicted while its call ran."""
+        if session.session_id not in self._sessions:
+            self._sessions[session.session_id] = session
+            self.total_bytes += session.size
+        session.last_used = time.monotonic()
+        self._sessions.move_to_end(session.session_id)
+
+    def create(self, provider: str) -> EditSession:
+        session = EditSession(provider)
+        self._sessions[session.session_id] = session
+        self._evict()
+        return session
+
+    def get(self, session_id: str, provider: str) -> Optional[EditSession]:
+        self._evict()
+        session = self._sessions.get(session_id)
+        if session is None or session.provider != provider:
+            return None
+        if session.pending_since:
+            if time.monotonic() - session.pending_since < EDIT_SESSION_PENDING_SECONDS:
+                # Busy: the caller will be turned away, so don't keep the session alive
+                return session
+            # Nobody polled the job to completion; stop waiting for it
+            self._by_response_url.pop(session.pending_response_url, None)
+            session.pending_response_url, session.pending_since = None, 0.0
+        self._touch(session)
+        return session
+
+    def record_gemini_turn(self, session: EditSession, user_turn, model_turn) -> None:
+        """Append one exchange, keeping only the last EDIT_SESSION_MAX_TURNS."""
+        history = (session.history + [user_turn, model_turn])[-2 * EDIT_SESSION_MAX_TURNS:]
+        size = sum(
+            len(part.inline_data.data or b"")
+            for content in history for part in (content.parts or []) if part.inline_data
+        )
+        self._touch(session)
+        self.total_bytes += size - session.size
+        session.history, session.size = history, size
+        self._evict()
+
+    def claim_fal_job(self, session: EditSession) -> None:
+        """Mark the session busy before submitting, so a concurrent follow-up is rejected."""
+        session.pending_since = time.monotonic()
+
+    def abandon_fal_job(self, session: EditSession) -> None:
+        """Undo a claim whose submit never produced a job."""
+        if session.pending_response_url is None:
+            session.pending_since = 0.0
+
+    def watch_fal_job(self, session: EditSession, response_url: str) -> None:
+        self._touch(session)
+        self._by_response_url.pop(session.pending_response_url, None)
+        session.pending_response_url = response_url
+        session.pending_since = time.monotonic()
+        self._by_response_url[response_url] = session.session_id
+        self._evict()
+
+    def finish_fal_job(self, response_url: str, image_url: Optional[str] = None) -> None:
+        """Advance the session to the job's result, or just unblock it if the job failed."""
+        session = self._sessions.get(self._by_response_url.pop(response_url, None))
+        # A job the session has since given up on must not overwrite a newer one
+        if session is None or session.pending_response_url != response_url:
+            return
+        session.pending_response_url, session.pending_since = None, 0.0
+        if image_url:
+            session.image_url = image_url
+
+    def snapshot(self) -> dict:
+        self._evict()
+        return {"sessions": len(self._sessions), "bytes": self.total_bytes}
+
+
+edit_sessions = EditSessionStore()
+
+
+def build_edit_prompt(prompt: str) -> str:
+    return f"""You are an expert photo editor AI. Your task is to perform a natural edit on the provided image based on the user's request.
+
+User Request: "{prompt}"
+
+Editing Guidelines:
+- Apply the requested edit to the image while maintaining photorealism
+- Keep the overall composition and style consistent
+- Make the edit blend seamlessly with the rest of the image
+
+Output: Return ONLY the final edited image. Do not return text."""
+
+
 # ── Pydantic models ───────────────────────────────────────────────────────────
 class ImageGenerationRequest(BaseModel):
     prompt: str
     aspect_ratio: str = "1:1"
     output_resolution: str = "1K"
     output_format: str = "png"
+    deadline_seconds: Optional[float] = None
 
 
 class ImageEditRequest(BaseModel):
@@ -170,12 +1020,13 @@ class ImageEditRequest(BaseModel):
     aspect_ratio: str = "1:1"
     output_resolution: str = "1K"
     output_format: str = "png"
+    deadline_seconds: Optional[float] = None
 
 
-# ── Gemini response helper ────────────────────────────────────────────────────
+# ── Gemini helpers ────────────────────────────────────────────────────────────
 def process_image_response(response):
-    """Extract base64 image data and mime type from a Gemini response."""
-    image_data = None
+    """Extract raw image bytes and mime type from a Gemini response."""
+    image_bytes = None
     mime_type = "image/png"
     try:
         if hasattr(response, 'candidates') and response.candidates:
@@ -188,20 +1039,78 @@ def process_image_response(response):
                                 mime_type = part.inline_data.mime_type
                             if hasattr(part.inline_data, 'data'):
                                 raw = part.inline_data.data
-                                image_data = base64.b64encode(raw).decode('utf-8') if isinstance(raw, bytes) else raw
+                                image_bytes = raw if isinstance(raw, bytes) else base64.b64decode(raw)
                                 break
                         elif hasattr(part, 'inlineData') and part.inlineData:
                             if hasattr(part.inlineData, 'mime_type') and part.inlineData.mime_type:
                                 mime_type = part.inlineData.mime_type
                             if hasattr(part.inlineData, 'data'):
                                 raw = part.inlineData.data
-                                image_data = base64.b64encode(raw).decode('utf-8') if isinstance(raw, bytes) else raw
+                                image_bytes = raw if isinstance(raw, bytes) else base64.b64decode(raw)
                                 break
     except Exception as e:
         print(f"Error in process_image_response: {e}")
         import traceback
         traceback.print_exc()
-    return image_data, mime_type
+    return image_bytes, mime_type
+
+
+def image_json_response(payload: dict, image_bytes: bytes) -> Response:
+    """
+    JSON response with `image` as base64 — the only place image bytes are encoded.
+
+    base64 output is plain ASCII, so it is spliced into the body as bytes rather
+    than decoded to str and re-encoded by the JSON serializer.
+    """
+    head = json.dumps(payload)[:-1].encode("utf-8")
+    body = b"".join((head, b', "image": "' if payload else b'"image": "', base64.b64encode(image_bytes), b'"}'))
+    return Response(content=body, media_type="application/json")
+
+
+async def generate_gemini_image(
+    contents: list,
+    aspect_ratio: str,
+    output_resolution: str,
+    deadline: Deadline,
+    http_request: Optional[Request],
+    endpoint: str,
+):
+    """
+    Run a Gemini image request under the caller's deadline.
+
+    Tries GEMINI_MODEL, then each of GEMINI_FALLBACK_MODELS, skipping models
+    whose breaker is open. Returns (response, model_used); if every model is
+    unavailable the last error is raised.
+    """
+    last_error = None
+    for model in [GEMINI_MODEL] + GEMINI_FALLBACK_MODELS:
+        try:
+            response = await run_upstream(
+                client.aio.models.generate_content(
+                    model=model,
+                    contents=contents,
+                    config=types.GenerateContentConfig(
+                        response_modalities=["IMAGE", "TEXT"],
+                        image_config=types.ImageConfig(
+                            aspect_ratio=aspect_ratio,
+                            image_size=output_resolution,
+                        ),
+                        http_options=deadline.gemini_http_options(),
+                    )
+                ),
+                deadline, http_request, endpoint, breaker=f"gemini:{model}",
+            )
+            return response, model
+        except CircuitOpen as e:
+            last_error = e
+        except (DeadlineExceeded, ClientDisconnected):
+            raise
+        except Exception as e:
+            if not is_provider_fault(e):
+                raise
+            print(f"[gemini] {model} failed: {type(e).__name__}")
+            last_error = e
+    raise last_error
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -209,7 +1118,8 @@ def process_image_response(response):
 # ═══════════════════════════════════════════════════════════════════════════════
 
 @api.post("/generate_image")
-async def generate_image(request: ImageGenerationRequest, _: None = Depends(verify_token)):
+async def generate_image(request: ImageGenerationRequest, http_request: Request, _: Caller = Depends(verify_token)):
+    deadline = Deadline(request.deadline_seconds)
     try:
         aspect_ratio_info = {
             "1:1":  {"cinematic": "centered square composition"},
@@ -234,34 +1144,32 @@ Technical Specifications:
 
 Output: Return ONLY the final generated image. Do not return text."""
 
-        response = client.models.generate_content(
-            model=GEMINI_MODEL,
-            contents=[types.Content(role="user", parts=[types.Part.from_text(text=final_prompt)])],
-            config=types.GenerateContentConfig(
-                response_modalities=["IMAGE", "TEXT"],
-                image_config=types.ImageConfig(
-                    aspect_ratio=request.aspect_ratio,
-                    image_size=request.output_resolution,
-                )
-            )
+        response, model = await generate_gemini_image(
+            [types.Content(role="user", parts=[types.Part.from_text(text=final_prompt)])],
+            request.aspect_ratio, request.output_resolution,
+            deadline, http_request, "generate_image",
         )
 
-        image_data, mime_type = process_image_response(response)
+        image_bytes, mime_type = process_image_response(response)
 
-        if image_data:
-            return {
+        if image_bytes:
+            return image_json_response({
                 "message": "Image generated successfully",
                 "prompt": request.prompt,
                 "aspect_ratio": request.aspect_ratio,
-                "image": image_data,
                 "mime_type": mime_type,
-            }
+                "model": model,
+            }, image_bytes)
         return {
             "message": "Image generation completed, but no image data found",
             "prompt": request.prompt,
             "aspect_ratio": request.aspect_ratio,
             "response": str(response),
         }
+    except CircuitOpen as e:
+        return circuit_open_response(e)
+    except (DeadlineExceeded, ClientDisconnected) as e:
+        return {"error": str(e), "error_type": type(e).__name__}
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -270,83 +1178,85 @@ Output: Return ONLY the final generated image. Do not return text."""
 
 @api.post("/edit_image")
 async def edit_image(
+    http_request: Request,
     prompt: str = Form(...),
     aspect_ratio: str = Form(default="1:1"),
     output_resolution: str = Form(default="1K"),
     output_format: str = Form(default="png"),
     image_urls: str = Form(default=""),
     image_file: UploadFile = File(default=None),
-    _: None = Depends(verify_token)
+    session_id: str = Form(default=""),      # continue an edit session instead of sending an image
+    deadline_seconds: Optional[float] = Form(default=None),
+    _: Caller = Depends(verify_token)
 ):
+    deadline = Deadline(deadline_seconds)
     try:
-        if not image_urls.strip() and (not image_file or not image_file.filename):
+        session = None
+        if session_id.strip():
+            session = edit_sessions.get(session_id.strip(), "gemini")
+            if session is None:
+                return {"error": "Edit session not found or expired", "error_type": "SessionNotFound"}
+        elif not image_urls.strip() and (not image_file or not image_file.filename):
             return {"error": "No image provided. Please upload an image file or provide an image URL."}
 
-        parts = []
+        # Uploaded bytes go straight into Gemini parts; the SDK encodes them on the wire
+        content_parts = []
 
-        if image_urls.strip():
+        # Follow-ups in a session get the previous image from the chat history instead
+        if session is None and image_urls.strip():
             try:
-                img_resp = requests.get(image_urls, timeout=30)
-                img_resp.raise_for_status()
-                image_data = base64.b64encode(img_resp.content).decode('utf-8')
-                parts.append({"inlineData": {"mimeType": "image/jpeg", "data": image_data}})
+                local_id = parse_local_image_id(image_urls)
+                local = await load_local_image(local_id, deadline, http_request, "edit_image") if local_id else None
+                if local is not None:
+                    # Mirrored result — read from the local store instead of the CDN
+                    image_bytes, url_mime_type = local
+                else:
+                    async with httpx.AsyncClient(timeout=deadline.http_timeout()) as http:
+                        img_resp = await run_upstream(http.get(image_urls), deadline, http_request, "edit_image")
+                    img_resp.raise_for_status()
+                    image_bytes, url_mime_type = img_resp.content, "image/jpeg"
+                content_parts.append(types.Part.from_bytes(data=image_bytes, mime_type=url_mime_type))
+            except (DeadlineExceeded, ClientDisconnected):
+                raise
             except Exception as e:
                 return {"error": f"Failed to fetch image from URL: {e}"}
 
-        if image_file and image_file.filename:
+        if session is None and image_file and image_file.filename:
             content = await image_file.read()
-            image_data = base64.b64encode(content).decode('utf-8')
-            parts.append({"inlineData": {"mimeType": image_file.content_type, "data": image_data}})
-
-        detailed_prompt = f"""You are an expert photo editor AI. Your task is to perform a natural edit on the provided image based on the user's request.
+            content_parts.append(types.Part.from_bytes(data=content, mime_type=image_file.content_type or "image/png"))
 
-User Request: "{prompt}"
+        content_parts.append(types.Part.from_text(text=build_edit_prompt(prompt)))
 
-Editing Guidelines:
-- Apply the requested edit to the image while maintaining photorealism
-- Keep the overall composition and style consistent
-- Make the edit blend seamlessly with the rest of the image
-
-Output: Return ONLY the final edited image. Do not return text."""
-
-        parts.append({"text": detailed_prompt})
-
-        content_parts = []
-        for part in parts:
-            if "inlineData" in part:
-                content_parts.append(types.Part(
-                    inline_data=types.Blob(mime_type=part["inlineData"]["mimeType"], data=part["inlineData"]["data"])
-                ))
-            elif "text" in part:
-                content_parts.append(types.Part.from_text(text=part["text"]))
-
-        response = client.models.generate_content(
-            model=GEMINI_MODEL,
-            contents=[types.Content(role="user", parts=content_parts)],
-            config=types.GenerateContentConfig(
-                response_modalities=["IMAGE", "TEXT"],
-                image_config=types.ImageConfig(
-                    aspect_ratio=aspect_ratio,
-                    image_size=output_resolution,
-                )
-            )
+        user_turn = types.Content(role="user", parts=content_parts)
+        history = session.history if session else []
+        response, model = await generate_gemini_image(
+            history + [user_turn], aspect_ratio, output_resolution,
+            deadline, http_request, "edit_image",
         )
 
-        image_data, mime_type = process_image_response(response)
+        image_bytes, mime_type = process_image_response(response)
 
-        if image_data:
-            return {
+        if image_bytes:
+            if session is None:
+                session = edit_sessions.create("gemini")
+            edit_sessions.record_gemini_turn(session, user_turn, response.candidates[0].content)
+            return image_json_response({
                 "message": "Image edited successfully",
                 "prompt": prompt,
                 "aspect_ratio": aspect_ratio,
-                "image": image_data,
                 "mime_type": mime_type,
-            }
+                "model": model,
+                "session_id": session.session_id,
+            }, image_bytes)
         return {
             "message": "Image editing completed, but no image data found",
             "prompt": prompt,
             "response": str(response),
         }
+    except CircuitOpen as e:
+        return circuit_open_response(e)
+    except (DeadlineExceeded, ClientDisconnected) as e:
+        return {"error": str(e), "error_type": type(e).__name__}
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -355,21 +1265,23 @@ Output: Return ONLY the final edited image. Do not return text."""
 
 @api.post("/compose_images")
 async def compose_images(
+    http_request: Request,
     prompt: str = Form(...),
     aspect_ratio: str = Form(default="1:1"),
     output_resolution: str = Form(default="1K"),
     output_format: str = Form(default="png"),
     image_files: List[UploadFile] = File(default=[]),
-    _: None = Depends(verify_token)
+    deadline_seconds: Optional[float] = Form(default=None),
+    _: Caller = Depends(verify_token)
 ):
+    deadline = Deadline(deadline_seconds)
     try:
-        parts = []
+        content_parts = []
 
         for image_file in image_files:
             if image_file.filename:
                 content = await image_file.read()
-                image_data = base64.b64encode(content).decode('utf-8')
-                parts.append({"inlineData": {"mimeType": image_file.content_type, "data": image_data}})
+                content_parts.append(types.Part.from_bytes(data=content, mime_type=image_file.content_type or "image/png"))
 
         detailed_prompt = f"""You are an expert photo editor AI. Your task is to compose the provided images into a single cohesive image based on the user's request.
 
@@ -382,43 +1294,31 @@ Composition Guidelines:
 
 Output: Return ONLY the final composed image. Do not return text."""
 
-        parts.append({"text": detailed_prompt})
+        content_parts.append(types.Part.from_text(text=detailed_prompt))
 
-        content_parts = []
-        for part in parts:
-            if "inlineData" in part:
-                content_parts.append(types.Part(
-                    inline_data=types.Blob(mime_type=part["inlineData"]["mimeType"], data=part["inlineData"]["data"])
-                ))
-            elif "text" in part:
-                content_parts.append(types.Part.from_text(text=part["text"]))
-
-        response = client.models.generate_content(
-            model=GEMINI_MODEL,
-            contents=[types.Content(role="user", parts=content_parts)],
-            config=types.GenerateContentConfig(
-                response_modalities=["IMAGE", "TEXT"],
-                image_config=types.ImageConfig(
-                    aspect_ratio=aspect_ratio,
-                    image_size=output_resolution,
-                )
-            )
+        response, model = await generate_gemini_image(
+            [types.Content(role="user", parts=content_parts)], aspect_ratio, output_resolution,
+            deadline, http_request, "compose_images",
         )
 
-        image_data, mime_type = process_image_response(response)
+        image_bytes, mime_type = process_image_response(response)
 
-        if image_data:
-            return {
+        if image_bytes:
+            return image_json_response({
                 "message": "Images composed successfully",
                 "prompt": prompt,
-                "image": image_data,
                 "mime_type": mime_type,
-            }
+                "model": model,
+            }, image_bytes)
         return {
             "message": "Image composition completed, but no image data found",
             "prompt": prompt,
             "response": str(response),
         }
+    except CircuitOpen as e:
+        return circuit_open_response(e)
+    except (DeadlineExceeded, ClientDisconnected) as e:
+        return {"error": str(e), "error_type": type(e).__name__}
     except Exception as e:
         return {"error": str(e)}
 
@@ -427,10 +1327,53 @@ Output: Return ONLY the final composed image. Do not return text."""
 # Fal.AI (GPT Image 2) endpoints
 # ═══════════════════════════════════════════════════════════════════════════════
 
+async def submit_fal_job(
+    model_path: str,
+    payload: dict,
+    deadline: Deadline,
+    http_request: Optional[Request],
+    endpoint: str,
+) -> dict:
+    """
+    Submit a job to the Fal.AI queue and return the ids/URLs the browser polls with.
+
+    The caller first waits for a Fal.AI job slot, which stays held until
+    /fal/poll reports the job finished.
+    """
+    async def _submit():
+        async with httpx.AsyncClient(timeout=deadline.http_timeout()) as http:
+            resp = await http.post(
+                f"{FAL_QUEUE_URL}/{model_path}",
+                json=payload,
+                headers={"Authorization": f"Key {FAL_KEY}"},
+            )
+            resp.raise_for_status()
+            return resp.json()
+
+    ticket = await fal_jobs.acquire(http_request, deadline, endpoint)
+    try:
+        # raise_for_status runs inside the guarded call so 5xx responses count against the breaker
+        data = await run_upstream(_submit(), deadline, http_request, endpoint, breaker=f"fal:{model_path}")
+        print(f"[FAL submit {endpoint}] response keys: {list(data.keys())}, status_url={data.get('status_url')}")
+        status_url = data.get("status_url") or f"{FAL_QUEUE_URL}/{model_path}/requests/{data['request_id']}/status"
+        response_url = data.get("response_url") or f"{FAL_QUEUE_URL}/{model_path}/requests/{data['request_id']}"
+    except BaseException:
+        fal_jobs.release(ticket)
+        raise
+    fal_jobs.watch(ticket, response_url)
+    return {
+        "status": "queued",
+        "request_id": data["request_id"],
+        "status_url": status_url,
+        "response_url": response_url,
+    }
+
+
 @api.post("/fal/generate_image")
-async def fal_generate_image(request: ImageGenerationRequest, _: None = Depends(verify_token)):
+async def fal_generate_image(request: ImageGenerationRequest, http_request: Request, _: Caller = Depends(verify_token)):
     if not FAL_KEY:
         return {"error": "FAL_KEY environment variable is not configured"}
+    deadline = Deadline(request.deadline_seconds)
     try:
         image_size = compute_fal_image_size(request.aspect_ratio, request.output_resolution)
         payload = {
@@ -440,25 +1383,11 @@ async def fal_generate_image(request: ImageGenerationRequest, _: None = Depends(
             "output_format": request.output_format,
             "num_images": 1,
         }
-        model_path = "openai/gpt-image-2"
-        async with httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=10.0)) as http:
-            resp = await http.post(
-                f"{FAL_QUEUE_URL}/{model_path}",
-                json=payload,
-                headers={"Authorization": f"Key {FAL_KEY}"},
-            )
-            resp.raise_for_status()
-            data = resp.json()
-
-        print(f"[FAL submit generate] response keys: {list(data.keys())}, status_url={data.get('status_url')}")
-        status_url = data.get("status_url") or f"{FAL_QUEUE_URL}/{model_path}/requests/{data['request_id']}/status"
-        response_url = data.get("response_url") or f"{FAL_QUEUE_URL}/{model_path}/requests/{data['request_id']}"
-        return {
-            "status": "queued",
-            "request_id": data["request_id"],
-            "status_url": status_url,
-            "response_url": response_url,
-        }
+        return await submit_fal_job("openai/gpt-image-2", payload, deadline, http_request, "fal_generate_image")
+    except CircuitOpen as e:
+        return circuit_open_response(e)
+    except (DeadlineExceeded, ClientDisconnected) as e:
+        return {"error": str(e), "error_type": type(e).__name__}
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -467,30 +1396,51 @@ async def fal_generate_image(request: ImageGenerationRequest, _: None = Depends(
 
 @api.post("/fal/edit_image")
 async def fal_edit_image(
+    http_request: Request,
     prompt: str = Form(...),
     aspect_ratio: str = Form(default="1:1"),
     output_resolution: str = Form(default="1K"),
     output_format: str = Form(default="png"),
     image_url: str = Form(default=""),       # https:// URL or data: URI
     image_file: UploadFile = File(default=None),
-    _: None = Depends(verify_token)
+    session_id: str = Form(default=""),      # continue an edit session instead of sending an image
+    deadline_seconds: Optional[float] = Form(default=None),
+    _: Caller = Depends(verify_token)
 ):
     if not FAL_KEY:
         return {"error": "FAL_KEY environment variable is not configured"}
+    deadline = Deadline(deadline_seconds)
+    fal_url = None
+    session = None
+    claimed = False
     try:
-        fal_url = None
-
-        if image_url.strip():
+        if session_id.strip():
+            session = edit_sessions.get(session_id.strip(), "fal")
+            if session is None:
+                return {"error": "Edit session not found or expired", "error_type": "SessionNotFound"}
+            if session.pending_since:
+                return {"error": "The previous edit in this session is still running", "error_type": "SessionBusy"}
+            # Claim the session before any await; released below if no job gets submitted
+            edit_sessions.claim_fal_job(session)
+            claimed = True
+            fal_url = await resolve_fal_input_url(session.image_url, deadline, http_request, "fal_edit_image")
+        elif image_url.strip():
             if image_url.startswith("data:"):
                 # Decode and upload to fal CDN — avoids large base64 payload to FAL
                 header, b64data = image_url.split(",", 1)
                 content_type = header.split(";")[0].split(":")[1]
-                fal_url = await upload_to_fal_storage(base64.b64decode(b64data), content_type)
+                fal_url = await run_upstream(
+                    upload_to_fal_storage(base64.b64decode(b64data), content_type),
+                    deadline, http_request, "fal_edit_image", breaker="fal:storage",
+                )
             else:
-                fal_url = image_url.strip()
+                fal_url = await resolve_fal_input_url(image_url, deadline, http_request, "fal_edit_image")
         elif image_file and image_file.filename:
             content = await image_file.read()
-            fal_url = await upload_to_fal_storage(content, image_file.content_type or "image/png")
+            fal_url = await run_upstream(
+                upload_to_fal_storage(content, image_file.content_type or "image/png"),
+                deadline, http_request, "fal_edit_image", breaker="fal:storage",
+            )
         else:
             return {"error": "No image provided"}
 
@@ -503,43 +1453,42 @@ async def fal_edit_image(
             "output_format": output_format,
             "num_images": 1,
         }
-        model_path = "openai/gpt-image-2/edit"
-        async with httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=10.0)) as http:
-            resp = await http.post(
-                f"{FAL_QUEUE_URL}/{model_path}",
-                json=payload,
-                headers={"Authorization": f"Key {FAL_KEY}"},
-            )
-            resp.raise_for_status()
-            data = resp.json()
-
-        print(f"[FAL submit edit] response keys: {list(data.keys())}, status_url={data.get('status_url')}")
-        status_url = data.get("status_url") or f"{FAL_QUEUE_URL}/{model_path}/requests/{data['request_id']}/status"
-        response_url = data.get("response_url") or f"{FAL_QUEUE_URL}/{model_path}/requests/{data['request_id']}"
-        return {
-            "status": "queued",
-            "request_id": data["request_id"],
-            "status_url": status_url,
-            "response_url": response_url,
-        }
+        result = await submit_fal_job("openai/gpt-image-2/edit", payload, deadline, http_request, "fal_edit_image")
+        if session is None:
+            session = edit_sessions.create("fal")
+            session.image_url = fal_url
+        # /fal/poll moves the session on to this job's result once it completes
+        edit_sessions.watch_fal_job(session, result["response_url"])
+        result["session_id"] = session.session_id
+        return result
+    except CircuitOpen as e:
+        return circuit_open_response(e)
+    except (DeadlineExceeded, ClientDisconnected) as e:
+        return {"error": str(e), "error_type": type(e).__name__}
     except Exception as e:
         import traceback
         traceback.print_exc()
         return {"error": str(e), "error_type": type(e).__name__}
+    finally:
+        if claimed:
+            edit_sessions.abandon_fal_job(session)
 
 
 @api.post("/fal/compose_images")
 async def fal_compose_images(
+    http_request: Request,
     prompt: str = Form(...),
     aspect_ratio: str = Form(default="1:1"),
     output_resolution: str = Form(default="1K"),
     output_format: str = Form(default="png"),
     image_urls: str = Form(default=""),          # JSON array of URL / data: URI strings
     image_files: List[UploadFile] = File(default=[]),
-    _: None = Depends(verify_token)
+    deadline_seconds: Optional[float] = Form(default=None),
+    _: Caller = Depends(verify_token)
 ):
     if not FAL_KEY:
         return {"error": "FAL_KEY environment variable is not configured"}
+    deadline = Deadline(deadline_seconds)
     try:
         fal_urls = []
 
@@ -551,9 +1500,12 @@ async def fal_compose_images(
                     if url.startswith("data:"):
                         header, b64data = url.split(",", 1)
                         content_type = header.split(";")[0].split(":")[1]
-                        fal_urls.append(await upload_to_fal_storage(base64.b64decode(b64data), content_type))
+                        fal_urls.append(await run_upstream(
+                            upload_to_fal_storage(base64.b64decode(b64data), content_type),
+                            deadline, http_request, "fal_compose_images", breaker="fal:storage",
+                        ))
                     else:
-                        fal_urls.append(url)
+                        fal_urls.append(await resolve_fal_input_url(url, deadline, http_request, "fal_compose_images"))
             except (json.JSONDecodeError, ValueError):
                 pass
 
@@ -561,7 +1513,10 @@ async def fal_compose_images(
         for image_file in image_files:
             if image_file.filename:
                 content = await image_file.read()
-                fal_urls.append(await upload_to_fal_storage(content, image_file.content_type or "image/png"))
+                fal_urls.append(await run_upstream(
+                    upload_to_fal_storage(content, image_file.content_type or "image/png"),
+                    deadline, http_request, "fal_compose_images", breaker="fal:storage",
+                ))
 
         if not fal_urls:
             return {"error": "No images provided"}
@@ -575,25 +1530,11 @@ async def fal_compose_images(
             "output_format": output_format,
             "num_images": 1,
         }
-        model_path = "openai/gpt-image-2/edit"
-        async with httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=10.0)) as http:
-            resp = await http.post(
-                f"{FAL_QUEUE_URL}/{model_path}",
-                json=payload,
-                headers={"Authorization": f"Key {FAL_KEY}"},
-            )
-            resp.raise_for_status()
-            data = resp.json()
-
-        print(f"[FAL submit compose] response keys: {list(data.keys())}, status_url={data.get('status_url')}")
-        status_url = data.get("status_url") or f"{FAL_QUEUE_URL}/{model_path}/requests/{data['request_id']}/status"
-        response_url = data.get("response_url") or f"{FAL_QUEUE_URL}/{model_path}/requests/{data['request_id']}"
-        return {
-            "status": "queued",
-            "request_id": data["request_id"],
-            "status_url": status_url,
-            "response_url": response_url,
-        }
+        return await submit_fal_job("openai/gpt-image-2/edit", payload, deadline, http_request, "fal_compose_images")
+    except CircuitOpen as e:
+        return circuit_open_response(e)
+    except (DeadlineExceeded, ClientDisconnected) as e:
+        return {"error": str(e), "error_type": type(e).__name__}
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -601,15 +1542,22 @@ async def fal_compose_images(
 
 
 @api.get("/fal/poll")
-async def fal_poll(status_url: str, response_url: str, _: None = Depends(verify_token)):
+async def fal_poll(
+    status_url: str,
+    response_url: str,
+    http_request: Request,
+    deadline_seconds: Optional[float] = None,
+    _: Caller = Depends(verify_token)
+):
     if not FAL_KEY:
         return {"error": "FAL_KEY environment variable is not configured"}
+    deadline = Deadline(deadline_seconds)
     try:
         print(f"[FAL poll] status_url={status_url}")
-        async with httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=10.0)) as http:
-            status_resp = await http.get(
-                status_url,
-                headers={"Authorization": f"Key {FAL_KEY}"},
+        async with httpx.AsyncClient(timeout=deadline.http_timeout()) as http:
+            status_resp = await run_upstream(
+                http.get(status_url, headers={"Authorization": f"Key {FAL_KEY}"}),
+                deadline, http_request, "fal_poll",
             )
             status_resp.raise_for_status()
             status_data = status_resp.json()
@@ -617,12 +1565,14 @@ async def fal_poll(status_url: str, response_url: str, _: None = Depends(verify_
             print(f"[FAL poll] status={status}")
 
             if status == "COMPLETED":
-                result_resp = await http.get(
-                    response_url,
-                    headers={"Authorization": f"Key {FAL_KEY}"},
+                result_resp = await run_upstream(
+                    http.get(response_url, headers={"Authorization": f"Key {FAL_KEY}"}),
+                    deadline, http_request, "fal_poll",
                 )
                 if not result_resp.is_success:
                     # FAL completed but result fetch failed (e.g. downstream error)
+                    edit_sessions.finish_fal_job(response_url)
+                    fal_jobs.finish(response_url)
                     try:
                         err_data = result_resp.json()
                         msg = err_data.get("detail", [{}])
@@ -634,12 +1584,26 @@ async def fal_poll(status_url: str, response_url: str, _: None = Depends(verify_
                 result_data = result_resp.json()
                 images = result_data.get("images", [])
                 if not images:
+                    edit_sessions.finish_fal_job(response_url)
+                    fal_jobs.finish(response_url)
                     return {"status": "FAILED", "error": "No images in result"}
-                return {"status": "COMPLETED", "image_url": images[0]["url"]}
+                # Serve from our origin; the CDN copy is mirrored in the background
+                source_url = images[0]["url"]
+                image_id = schedule_image_mirror(source_url)
+                image_url = f"/api/images/{image_id}" if image_id else source_url
+                edit_sessions.finish_fal_job(response_url, image_url)
+                fal_jobs.finish(response_url)
+                return {"status": "COMPLETED", "image_url": image_url, "source_url": source_url}
             elif status in ("FAILED", "ERROR"):
+                edit_sessions.finish_fal_job(response_url)
+                fal_jobs.finish(response_url)
                 return {"status": "FAILED", "error": status_data.get("error", "Generation failed")}
             else:
                 return {"status": status}
+    except CircuitOpen as e:
+        return circuit_open_response(e)
+    except (DeadlineExceeded, ClientDisconnected) as e:
+        return {"error": str(e), "error_type": type(e).__name__}
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -649,11 +1613,10 @@ async def fal_poll(status_url: str, response_url: str, _: None = Depends(verify_
 # ── Utility ───────────────────────────────────────────────────────────────────
 
 @api.get("/download_image/{image_data}")
-async def download_image(image_data: str, _: None = Depends(verify_token)):
+async def download_image(image_data: str, _: Caller = Depends(verify_token)):
     try:
-        image_bytes = base64.b64decode(image_data)
-        return StreamingResponse(
-            io.BytesIO(image_bytes),
+        return Response(
+            content=base64.b64decode(image_data),
             media_type="image/png",
             headers={"Content-Disposition": "attachment; filename=generated_image.png"}
         )
@@ -661,6 +1624,53 @@ async def download_image(image_data: str, _: None = Depends(verify_token)):
         return {"error": str(e)}
 
 
+@api.get("/images/{image_id}")
+async def get_image(image_id: str, http_request: Request):
+    # Unauthenticated so <img> tags can load it; the id is an unguessable hash
+    if not _IMAGE_ID_RE.fullmatch(image_id):
+        raise HTTPException(status_code=404, detail="Image not found")
+    task = _mirror_tasks.get(image_id)
+    if task is not None:
+        await asyncio.shield(task)
+    meta = read_image_meta(image_id)
+    if meta is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    data_path, _ = _image_paths(image_id)
+    if not os.path.exists(data_path):
+        # Mirroring failed — fall back to the CDN copy
+        return RedirectResponse(meta["source_url"], status_code=307)
+    etag = f'"{image_id}"'
+    cache_headers = {"Cache-Control": IMAGE_CACHE_CONTROL, "ETag": etag}
+    if http_request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=cache_headers)
+    return FileResponse(data_path, media_type=meta.get("content_type", "image/png"), headers=cache_headers)
+
+
+@api.get("/health")
+async def health():
+    # Unauthenticated so load balancers and scripts/health-check.sh can probe it
+    snapshot = {name: breaker.snapshot() for name, breaker in breakers.items()}
+    degraded = any(b["state"] != "closed" for b in snapshot.values())
+    return {
+        "status": "degraded" if degraded else "ok",
+        "gemini_models": [GEMINI_MODEL] + GEMINI_FALLBACK_MODELS,
+        "breakers": snapshot,
+    }
+
+
+@api.get("/metrics")
+async def metrics(_: Caller = Depends(verify_token)):
+    return {
+        "cancelled": dict(request_metrics["cancelled"]),
+        "deadline_exceeded": dict(request_metrics["deadline_exceeded"]),
+        "edit_sessions": edit_sessions.snapshot(),
+        "scheduler": {
+            **{provider: s.snapshot() for provider, s in schedulers.items()},
+            "fal_jobs": fal_jobs.scheduler.snapshot(),
+        },
+    }
+
+
 # ── Mount apps ────────────────────────────────────────────────────────────────
 app.mount("/api", api, name="api")
 
@@ -29,7 +29,8 @@ function startFalPolling(statusUrl, responseUrl, intervalMs, onComplete, onError
       )
       const data = await resp.json()
       if (data.error) return onError(data.error)
-      if (data.status === 'COMPLETED') return onComplete(data.image_url)
+      // image_url is served from our origin; resolve it so it is treated like any other http(s) URL
+      if (data.status === 'COMPLETED') return onComplete(new URL(data.image_url, window.location.href).href)
       if (data.status === 'FAILED') return onError(data.error || 'Generation failed')
       setTimeout(doPoll, intervalMs)
     } catch (err) {
@@ -18,7 +18,7 @@ export function LoginScreen({ onLogin }) {
       const res = await fetch('/api/auth/login', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ password })
+        body: JSON.stringify({ password, priority: 'interactive' })
       })
       const data = await res.json()
       if (!res.ok) {
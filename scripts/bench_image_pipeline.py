@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Image Pipeline Micro-benchmark
+Compares the legacy base64-string image flow in backend/main.py with the
+raw-bytes flow, reporting peak allocations and CPU time per MB of image.
+
+Run from anywhere:  python scripts/bench_image_pipeline.py
+"""
+
+import base64
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# backend/main.py needs an API key and the frontend/public directory at import time;
+# no network calls are made.
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+os.chdir(REPO_ROOT)
+sys.path.insert(0, str(REPO_ROOT / "backend"))
+
+import main  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+from google.genai import types  # noqa: E402
+
+# Typical PNG sizes for Nano Banana output resolutions (random bytes, like
+# compressed image data, so nothing shortcuts the copies)
+SIZES = {"1K": 1_500_000, "2K": 6_000_000, "4K": 24_000_000}
+RUNS = 5
+MB = 1024 * 1024
+
+
+def wire_encode(part):
+    """What the Gemini SDK does to inline bytes when building the request JSON."""
+    return base64.urlsafe_b64encode(part.inline_data.data).decode("ascii")
+
+
+# ── Legacy flow (before) ──────────────────────────────────────────────────────
+def legacy_request(upload: bytes):
+    image_data = base64.b64encode(upload).decode("utf-8")
+    part = {"inlineData": {"mimeType": "image/png", "data": image_data}}
+    gemini_part = types.Part(
+        inline_data=types.Blob(mime_type=part["inlineData"]["mimeType"], data=part["inlineData"]["data"])
+    )
+    return wire_encode(gemini_part)
+
+
+def legacy_response(result: bytes):
+    image_data = base64.b64encode(result).decode("utf-8")
+    return JSONResponse({
+        "message": "Image generated successfully",
+        "image": image_data,
+        "mime_type": "image/png",
+    }).body
+
+
+# ── Raw-bytes flow (after) ────────────────────────────────────────────────────
+def bytes_request(upload: bytes):
+    return wire_encode(types.Part.from_bytes(data=upload, mime_type="image/png"))
+
+
+def bytes_response(result: bytes):
+    return main.image_json_response({
+        "message": "Image generated successfully",
+        "mime_type": "image/png",
+    }, result).body
+
+
+def measure(fn, data: bytes):
+    """Return (peak allocated MB per image MB, CPU ms per image MB)."""
+    size_mb = len(data) / MB
+
+    tracemalloc.start()
+    fn(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    cpu = []
+    for _ in range(RUNS):
+        start = time.process_time()
+        fn(data)
+        cpu.append(time.process_time() - start)
+
+    return peak / MB / size_mb, statistics.median(cpu) * 1000 / size_mb
+
+
+def run():
+    print(f"{'size':<5} {'stage':<9} {'alloc MB/MB before':>19} {'after':>7} "
+          f"{'CPU ms/MB before':>17} {'after':>7}")
+    for label, size in SIZES.items():
+        data = os.urandom(size)
+        for stage, before, after in (
+            ("request", legacy_request, bytes_request),
+            ("response", legacy_response, bytes_response),
+        ):
+            alloc_before, cpu_before = measure(before, data)
+            alloc_after, cpu_after = measure(after, data)
+            print(f"{label:<5} {stage:<9} {alloc_before:>19.2f} {alloc_after:>7.2f} "
+                  f"{cpu_before:>17.2f} {cpu_after:>7.2f}")
+
+
+if __name__ == "__main__":
+    run()
@@ -40,8 +40,13 @@ check_app_health() {
     local attempt=1
 
     while [ $attempt -le $max_attempts ]; do
-        if curl -s -o /dev/null -w "%{http_code}" http://localhost:8000 | grep -q "200"; then
+        local body
+        if body=$(curl -sf http://localhost:8000/api/health); then
             log_success "Application is responding (HTTP 200)"
+            # Open or half-open circuit breakers mean a provider is failing
+            if echo "$body" | grep -q '"status":"degraded"'; then
+                log_warning "Upstream providers degraded (see /api/health breakers)"
+            fi
             return 0
         fi
 